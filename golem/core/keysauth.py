@@ -1,22 +1,44 @@
 import abc
+import binascii
 import logging
+import multiprocessing
 import os
+import sys
+import weakref
+from Queue import Empty
 from hashlib import sha256
 from _pysha3 import sha3_256, keccak_256
 
 import bitcoin
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
 from Crypto.PublicKey import RSA
 from Crypto.Signature.pkcs1_15 import PKCS115_SigScheme
 from Crypto.Hash import SHA256
 from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Util.number import GCD, inverse
+from secp256k1 import PrivateKey
 from abc import abstractmethod
-from crypto import ECCx
+from crypto import ECCx, ctx as secp256k1_ctx
 from golem.core.variables import PRIVATE_KEY, PUBLIC_KEY
 from simpleenv import get_local_datadir
 from simplehash import SimpleHash
 
 logger = logging.getLogger(__name__)
 
+# Minimal difficulty for which elliptical keys are mined on all cores
+PARALLEL_MINING_MIN_DIFFICULTY = 12
+# How often (in seconds) parallel mining checks whether its processes are still alive
+MINING_POLL_INTERVAL = 1
+
+# RSA keys parsed from files: path -> (mtime, size, key)
+_rsa_key_cache = {}
+# RSA public key -> key id
+_rsa_key_id_cache = weakref.WeakKeyDictionary()
+# Exported RSA public key -> imported key
+_rsa_public_key_cache = {}
+RSA_PUBLIC_KEY_CACHE_SIZE = 1024
+
 
 def sha3(seed):
     """ Return sha3-256 of seed in digest
@@ -27,7 +49,36 @@ def sha3(seed):
 
 
 def sha2(seed):
-    return int("0x" + sha256(seed).hexdigest(), 16)
+    return int(sha256(seed).hexdigest(), 16)
+
+
+def count_leading_zero_bits(digest):
+    """ Count zero bits at the beginning of binary digest
+    :param str digest: binary hash digest
+    :return int: number of leading zero bits
+    """
+    bits = 0
+    for byte in bytearray(digest):
+        if byte:
+            return bits + 8 - byte.bit_length()
+        bits += 8
+    return bits
+
+
+def has_leading_zero_bits(digest, bits):
+    """ Check whether binary digest starts with at least given number of zero bits
+    :param str digest: binary hash digest
+    :param int bits: required number of leading zero bits
+    :return bool: True if digest has at least @bits leading zero bits
+    """
+    if bits <= 0:
+        return True
+    zero_bytes, zero_bits = divmod(bits, 8)
+    if digest[:zero_bytes] != '\x00' * zero_bytes:
+        return False
+    if zero_bits == 0:
+        return True
+    return len(digest) > zero_bytes and ord(digest[zero_bytes]) >> (8 - zero_bits) == 0
 
 
 def mk_privkey(seed):
@@ -40,6 +91,78 @@ def privtopub(raw_privkey):
     return raw_pubkey
 
 
+def find_elliptical_keys(difficulty):
+    """ Draw elliptical key pairs until one of them meets given difficulty
+    :param int difficulty: desired key difficulty level
+    :return (str, str): private and public key
+    """
+    while True:
+        priv_key = mk_privkey(os.urandom(32))
+        if difficulty <= 0 or has_leading_zero_bits(privkey_to_key_id_digest(priv_key), difficulty):
+            return priv_key, privtopub(priv_key)
+
+
+def _put_elliptical_keys(difficulty, results):
+    results.put(find_elliptical_keys(difficulty))
+
+
+def mine_elliptical_keys(difficulty, processes=None):
+    """ Search for elliptical key pair with given difficulty in several processes. The first
+    pair found is returned and remaining processes are terminated.
+    :param int difficulty: desired key difficulty level
+    :param int|None processes: *Default: None* number of processes to use. If None then
+    number of CPU cores will be used
+    :return (str, str): private and public key
+    :raise RuntimeError: if all processes exited without finding a key pair
+    """
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_put_elliptical_keys, args=(difficulty, results))
+               for _ in xrange(processes or multiprocessing.cpu_count())]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        while True:
+            try:
+                return results.get(timeout=MINING_POLL_INTERVAL)
+            except Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+        # A worker may have put its result just before exiting
+        try:
+            return results.get_nowait()
+        except Empty:
+            raise RuntimeError("All key mining processes exited without finding a key")
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+
+def privkey_to_key_id_digest(raw_privkey):
+    """ Return sha256 of the elliptical key id (hex public key) derived from given private key.
+    Public key is computed with libsecp256k1 instead of the pure Python bitcoin module.
+    :param str raw_privkey: binary private key
+    :return str: binary hashed key id
+    """
+    raw_pubkey = PrivateKey(raw_privkey, raw=True, ctx=secp256k1_ctx).pubkey.serialize(compressed=False)[1:]
+    return sha256(binascii.hexlify(raw_pubkey)).digest()
+
+
+def generate_rsa_key(bits=2048):
+    """ Generate new RSA private key. Primes are searched by OpenSSL, which is much faster than
+    Crypto's pure Python generator, and the result is converted into Crypto's key object.
+    :param int bits: *Default: 2048* key length
+    :return _RSAobj: private key
+    """
+    numbers = rsa.generate_private_key(public_exponent=65537, key_size=bits,
+                                       backend=default_backend()).private_numbers()
+    # Numbers come straight from OpenSSL, no need to test them again in Python
+    return RSA.construct((numbers.public_numbers.n, numbers.public_numbers.e, numbers.d, numbers.p, numbers.q),
+                         consistency_check=False)
+
+
 def get_random(min_value=0, max_value=None):
     """
     Get cryptographically secure random integer in range
@@ -55,7 +178,7 @@ def get_random(min_value=0, max_value=None):
         raise ArithmeticError("max_value should be greater than min_value")
     if min_value == max_value:
         return min_value
-    return int((int(urandom(getsizeof(max_value)).encode('hex'), 16) % (max_value - min_value)) + min_value)
+    return int((int(binascii.hexlify(urandom(getsizeof(max_value))), 16) % (max_value - min_value)) + min_value)
 
 
 def get_random_float():
@@ -79,8 +202,7 @@ class KeysAuth(object):
         self.get_keys_dir(datadir)
         self.private_key_name = private_key_name
         self.public_key_name = public_key_name
-        self._private_key = self._load_private_key()
-        self.public_key = self._load_public_key()
+        self._private_key, self.public_key = self._load_keys()
         self.key_id = self.cnt_key_id(self.public_key)
 
     def get_difficulty(self, key_id=None):
@@ -89,15 +211,9 @@ class KeysAuth(object):
         use default key_id
         :return int: key_id difficulty
         """
-        difficulty = 0
         if key_id is None:
             key_id = self.key_id
-        min_hash = KeysAuth._count_min_hash(difficulty)
-        while sha2(key_id) <= min_hash:
-            difficulty += 1
-            min_hash = KeysAuth._count_min_hash(difficulty)
-
-        return difficulty - 1
+        return count_leading_zero_bits(sha256(key_id).digest())
 
     def get_public_key(self):
         """ Return public key """
@@ -203,16 +319,8 @@ class KeysAuth(object):
         return cls.__get_key_loc(key_name)
 
     @abc.abstractmethod
-    def _load_private_key(self):  # implement in derived classes
-        return
-
-    @abc.abstractmethod
-    def _load_public_key(self):  # implement in derived classes
-        return
-
-    @staticmethod
-    def _count_min_hash(difficulty):
-        return pow(2, 256 - difficulty)
+    def _load_keys(self):  # implement in derived classes
+        return None, None
 
 
 class RSAKeysAuth(KeysAuth):
@@ -223,18 +331,23 @@ class RSAKeysAuth(KeysAuth):
         :param public_key: public key that will be used to generate id
         :return str: new id
         """
-        return SimpleHash.hash_hex(public_key.exportKey("OpenSSH")[8:])
+        key_id = _rsa_key_id_cache.get(public_key)
+        if key_id is None:
+            key_id = RSAKeysAuth._compute_key_id(public_key)
+            _rsa_key_id_cache[public_key] = key_id
+        return key_id
 
     def encrypt(self, data, public_key=None):
         """ Encrypt given data with RSA
         :param str data: data that should be encrypted
-        :param None|_RSAobj public_key: *Default: None* public key that should be used to encrypt data.
+        :param None|_RSAobj|str public_key: *Default: None* public key that should be used to encrypt data.
+            Public key may be given as key object or in exported format.
             If public key is None than default public key will be used
         :return str: encrypted data
         """
         if public_key is None:
             public_key = self.public_key
-        return PKCS1_OAEP.new(public_key).encrypt(data)
+        return PKCS1_OAEP.new(self._import_public_key(public_key)).encrypt(data)
 
     def decrypt(self, data):
         """ Decrypt given data with RSA
@@ -258,38 +371,46 @@ class RSAKeysAuth(KeysAuth):
         Verify the validity of an RSA signature
         :param str sig: RSA signature
         :param str data: expected data
-        :param None|_RSAobj public_key: *Default: None* public key that should be used to verify signed data.
+        :param None|_RSAobj|str public_key: *Default: None* public key that should be used to verify signed data.
+            Public key may be given as key object or in exported format.
             If public key is None then default public key will be used
         :return bool: verification result
         """
         if public_key is None:
             public_key = self.public_key
         try:
-            PKCS115_SigScheme(public_key).verify(SHA256.new(data), sig)
+            PKCS115_SigScheme(self._import_public_key(public_key)).verify(SHA256.new(data), sig)
             return True
         except Exception as exc:
             logger.error("Cannot verify signature: {}".format(exc))
         return False
 
     def generate_new(self, difficulty):
-        """ Generate new pair of keys with given difficulty
+        """ Generate new pair of keys with given difficulty. Difficulty is reached by searching for
+        a public exponent, so for difficulty > 0 the exponent is usually not the standard 65537: it is
+        the first odd number from 65537 upwards, coprime with lcm(p - 1, q - 1), that gives a
+        matching key id. Expected exponent grows with difficulty (about 65537 + 2 ** (difficulty + 1)).
         :param int difficulty: desired key difficulty level
+        :raise TypeError: in case of incorrect @difficulty type
         """
-        min_hash = self._count_min_hash(difficulty)
-        priv_key = RSA.generate(2048)
-        pub_key = str(priv_key.publickey().n)
-        while sha2(pub_key) > min_hash:
-            priv_key = RSA.generate(2048)
-            pub_key = str(priv_key.publickey().n)
-        pub_key = priv_key.publickey()
-        priv_key_loc = RSAKeysAuth._get_private_key_loc(self.private_key_name)
-        pub_key_loc = RSAKeysAuth._get_public_key_loc(self.public_key_name)
-        with open(priv_key_loc, 'w') as f:
-            f.write(priv_key.exportKey('PEM'))
-        with open(pub_key_loc, 'w') as f:
-            f.write(pub_key.exportKey())
-        self.public_key = pub_key.exportKey()
-        self._private_key = priv_key.exportKey('PEM')
+        if not isinstance(difficulty, int):
+            raise TypeError("Incorrect 'difficulty' type: {}".format(type(difficulty)))
+        priv_key = generate_rsa_key()
+        if difficulty <= 0:
+            self._set_and_save(priv_key, priv_key.publickey())
+            return
+        # Primes are generated once; candidates differ only in the public exponent, so only
+        # public keys are built while searching and the private exponent is computed for the winner
+        n, e, p, q = priv_key.n, priv_key.e, priv_key.p, priv_key.q
+        lcm = (p - 1) * (q - 1) // GCD(p - 1, q - 1)
+        while not has_leading_zero_bits(sha256(self._compute_key_id(RSA.construct((n, e)))).digest(),
+                                        difficulty):
+            e += 2
+            while GCD(e, lcm) != 1:
+                e += 2
+        if e != priv_key.e:
+            priv_key = RSA.construct((n, e, inverse(e, lcm), p, q), consistency_check=False)
+        self._set_and_save(priv_key, priv_key.publickey())
 
     def load_from_file(self, file_name):
         """ Load private key from given file. If it's proper key, then generate public key and
@@ -329,8 +450,7 @@ class RSAKeysAuth(KeysAuth):
             return False
 
         try:
-            with open(private_key_loc, 'w') as f:
-                f.write(self._private_key.exportKey('PEM'))
+            RSAKeysAuth._write_private_key(private_key_loc, self._private_key)
             with open(public_key_loc, 'w') as f:
                 f.write(self.public_key.exportKey())
                 return True
@@ -349,34 +469,69 @@ class RSAKeysAuth(KeysAuth):
             return None
         return key
 
-    def _load_private_key(self):
+    def _load_keys(self):
         private_key_loc = RSAKeysAuth._get_private_key_loc(self.private_key_name)
         public_key_loc = RSAKeysAuth._get_public_key_loc(self.public_key_name)
         if not os.path.isfile(private_key_loc) or not os.path.isfile(public_key_loc):
-            RSAKeysAuth._generate_keys(private_key_loc, public_key_loc)
-        with open(private_key_loc) as f:
-            key = f.read()
-        key = RSA.importKey(key)
+            return RSAKeysAuth._generate_keys(private_key_loc, public_key_loc)
+        key = RSAKeysAuth._import_key_file(private_key_loc)
+        return key, key.publickey()
+
+    @staticmethod
+    def _compute_key_id(public_key):
+        return SimpleHash.hash_hex(public_key.exportKey("OpenSSH")[8:])
+
+    @staticmethod
+    def _import_public_key(public_key):
+        """ Return key object for public key, reusing keys already imported from the same exported form
+        :param _RSAobj|str public_key: key object or exported public key
+        :return _RSAobj: public key
+        """
+        if not isinstance(public_key, basestring):
+            return public_key
+        key = _rsa_public_key_cache.get(public_key)
+        if key is None:
+            key = RSA.importKey(public_key)
+            if len(_rsa_public_key_cache) >= RSA_PUBLIC_KEY_CACHE_SIZE:
+                _rsa_public_key_cache.clear()
+            _rsa_public_key_cache[public_key] = key
         return key
 
-    def _load_public_key(self):
-        private_key_loc = RSAKeysAuth._get_private_key_loc(self.private_key_name)
-        public_key_loc = RSAKeysAuth._get_public_key_loc(self.public_key_name)
-        if not os.path.isfile(private_key_loc) or not os.path.isfile(public_key_loc):
-            RSAKeysAuth._generate_keys(private_key_loc, public_key_loc)
-        with open(public_key_loc) as f:
-            key = f.read()
-        key = RSA.importKey(key)
+    @staticmethod
+    def _import_key_file(file_name):
+        """ Import RSA key from file, reusing the parsed key while the file stays unchanged
+        :param str file_name: file containing key
+        :return _RSAobj: imported key
+        """
+        stat = os.stat(file_name)
+        cached = _rsa_key_cache.get(file_name)
+        if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+        with open(file_name) as f:
+            key = RSA.importKey(f.read())
+        _rsa_key_cache[file_name] = (stat.st_mtime, stat.st_size, key)
         return key
 
+    @staticmethod
+    def _write_private_key(file_name, key):
+        """ Save private key in PEM format and store it in the parsed keys cache, so that the file
+        is not reported unchanged when its mtime and size happen to match the previous key
+        :param str file_name: where should private key be saved
+        :param _RSAobj key: private key
+        """
+        with open(file_name, 'w') as f:
+            f.write(key.exportKey('PEM'))
+        stat = os.stat(file_name)
+        _rsa_key_cache[file_name] = (stat.st_mtime, stat.st_size, key)
+
     @staticmethod
     def _generate_keys(private_key_loc, public_key_loc):
-        key = RSA.generate(2048)
+        key = generate_rsa_key()
         pub_key = key.publickey()
-        with open(private_key_loc, 'w') as f:
-            f.write(key.exportKey('PEM'))
+        RSAKeysAuth._write_private_key(private_key_loc, key)
         with open(public_key_loc, 'w') as f:
             f.write(pub_key.exportKey())
+        return key, pub_key
 
     def _set_and_save(self, private_key, public_key):
         self._private_key = private_key
@@ -384,8 +539,7 @@ class RSAKeysAuth(KeysAuth):
         self.key_id = self.cnt_key_id(self.public_key)
         private_key_loc = RSAKeysAuth._get_private_key_loc(self.private_key_name)
         public_key_loc = RSAKeysAuth._get_public_key_loc(self.public_key_name)
-        with open(private_key_loc, 'w') as f:
-            f.write(private_key.exportKey('PEM'))
+        RSAKeysAuth._write_private_key(private_key_loc, private_key)
         with open(public_key_loc, 'w') as f:
             f.write(public_key.exportKey())
 
@@ -400,19 +554,19 @@ class EllipticalKeysAuth(KeysAuth):
         :param uuid|None uuid: application identifier (to read keys)
         """
         KeysAuth.__init__(self, datadir, private_key_name, public_key_name)
-        try:
-            self.ecc = ECCx(None, self._private_key)
-        except AssertionError:
+        if not self._is_private_key_valid(self._private_key):
             private_key_loc = self._get_private_key_loc(private_key_name)
             public_key_loc = self._get_public_key_loc(public_key_name)
-            self._generate_keys(private_key_loc, public_key_loc)
+            self._private_key, self.public_key = self._generate_keys(private_key_loc, public_key_loc)
+            self.key_id = self.cnt_key_id(self.public_key)
+        self.ecc = ECCx(None, self._private_key)
 
     def cnt_key_id(self, public_key):
         """ Return id generated from given public key (in hex format).
         :param public_key: public key that will be used to generate id
         :return str: new id
         """
-        return public_key.encode('hex')
+        return binascii.hexlify(public_key)
 
     def encrypt(self, data, public_key=None):
         """ Encrypt given data with ECIES
@@ -424,7 +578,7 @@ class EllipticalKeysAuth(KeysAuth):
         if public_key is None:
             public_key = self.public_key
         if len(public_key) == 128:
-            public_key = public_key.decode('hex')
+            public_key = binascii.unhexlify(public_key)
         return ECCx.ecies_encrypt(data, public_key)
 
     def decrypt(self, data):
@@ -458,7 +612,7 @@ class EllipticalKeysAuth(KeysAuth):
             if public_key is None:
                 public_key = self.public_key
             if len(public_key) == 128:
-                public_key = public_key.decode('hex')
+                public_key = binascii.unhexlify(public_key)
             ecc = ECCx(public_key)
             return ecc.verify(sig, sha3(data))
         except AssertionError:
@@ -474,12 +628,12 @@ class EllipticalKeysAuth(KeysAuth):
         """
         if not isinstance(difficulty, int):
             raise TypeError("Incorrect 'difficulty' type: {}".format(type(difficulty)))
-        min_hash = self._count_min_hash(difficulty)
-        priv_key = mk_privkey(str(get_random_float()))
-        pub_key = privtopub(priv_key)
-        while sha2(self.cnt_key_id(pub_key)) > min_hash:
-            priv_key = mk_privkey(str(get_random_float()))
-            pub_key = privtopub(priv_key)
+        # Frozen (pyinstaller) executables would start the whole application in each new process
+        frozen = getattr(sys, 'frozen', False)
+        if difficulty < PARALLEL_MINING_MIN_DIFFICULTY or frozen:
+            priv_key, pub_key = find_elliptical_keys(difficulty)
+        else:
+            priv_key, pub_key = mine_elliptical_keys(difficulty)
         self._set_and_save(priv_key, pub_key)
 
     def load_from_file(self, file_name):
@@ -522,6 +676,10 @@ class EllipticalKeysAuth(KeysAuth):
         self.save_to_files(priv_key_loc, pub_key_loc)
         self.ecc = ECCx(None, self._private_key)
 
+    @staticmethod
+    def _is_private_key_valid(priv_key):
+        return len(priv_key) == 32 and 0 < bitcoin.decode_privkey(priv_key, 'bin') < bitcoin.N
+
     @staticmethod
     def _load_private_key_from_file(file_name):
         if not os.path.isfile(file_name):
@@ -530,27 +688,20 @@ class EllipticalKeysAuth(KeysAuth):
             key = f.read()
         return key
 
-    def _load_private_key(self):
+    def _load_keys(self):
         private_key_loc = EllipticalKeysAuth._get_private_key_loc(self.private_key_name)
         public_key_loc = EllipticalKeysAuth._get_public_key_loc(self.public_key_name)
         if not os.path.isfile(private_key_loc) or not os.path.isfile(public_key_loc):
-            EllipticalKeysAuth._generate_keys(private_key_loc, public_key_loc)
+            return EllipticalKeysAuth._generate_keys(private_key_loc, public_key_loc)
         with open(private_key_loc, 'rb') as f:
             key = f.read()
-        return key
-
-    def _load_public_key(self):
-        private_key_loc = EllipticalKeysAuth._get_private_key_loc(self.private_key_name)
-        public_key_loc = EllipticalKeysAuth._get_public_key_loc(self.public_key_name)
-        if not os.path.isfile(private_key_loc) or not os.path.isfile(public_key_loc):
-            EllipticalKeysAuth._generate_keys(private_key_loc, public_key_loc)
         with open(public_key_loc, 'rb') as f:
-            key = f.read()
-        return key
+            pub_key = f.read()
+        return key, pub_key
 
     @staticmethod
     def _generate_keys(private_key_loc, public_key_loc):
-        key = mk_privkey(str(get_random_float()))
+        key = mk_privkey(os.urandom(32))
         pub_key = privtopub(key)
 
         # Create dir for the keys.
@@ -564,3 +715,4 @@ class EllipticalKeysAuth(KeysAuth):
             f.write(key)
         with open(public_key_loc, 'wb') as f:
             f.write(pub_key)
+        return key, pub_key
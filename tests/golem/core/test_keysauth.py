@@ -1,14 +1,43 @@
+import sys
 import time
+from hashlib import sha256
 from os import path
+from Queue import Queue
 from random import random, randint
 
+from mock import Mock, patch
+
 from golem.core.crypto import ECCx
-from golem.core.keysauth import KeysAuth, EllipticalKeysAuth, RSAKeysAuth, get_random, get_random_float, sha2, sha3
+from golem.core.keysauth import KeysAuth, EllipticalKeysAuth, RSAKeysAuth, get_random, get_random_float, \
+    count_leading_zero_bits, generate_rsa_key, has_leading_zero_bits, mine_elliptical_keys, \
+    mk_privkey, privkey_to_key_id_digest, privtopub, sha2, sha3, \
+    PARALLEL_MINING_MIN_DIFFICULTY
 from golem.core.simpleserializer import CBORSerializer
 from golem.network.transport.message import MessageWantToComputeTask
 from golem.tools.testwithappconfig import TestWithKeysAuth
 
 
+class InProcessWorker(object):
+    """ Stand-in for multiprocessing.Process running the mining worker synchronously """
+
+    def __init__(self, target, args):
+        self.target = target
+        self.args = args
+        self.daemon = False
+
+    def start(self):
+        self.target(*self.args)
+
+    def is_alive(self):
+        return False
+
+    def terminate(self):
+        pass
+
+    def join(self):
+        pass
+
+
 class KeysAuthTest(TestWithKeysAuth):
 
     def test_sha(self):
@@ -19,6 +48,21 @@ class KeysAuthTest(TestWithKeysAuth):
         self.assertEqual(sha2(test_str), expected_sha2)
         self.assertEqual(sha3(test_str).encode('hex'), expected_sha3)
 
+    def test_count_leading_zero_bits(self):
+        self.assertEqual(count_leading_zero_bits("\xff" * 32), 0)
+        self.assertEqual(count_leading_zero_bits("\x00\x00\x1f" + "\xff" * 29), 19)
+        self.assertEqual(count_leading_zero_bits("\x00" * 31 + "\x01"), 255)
+        self.assertEqual(count_leading_zero_bits("\x00" * 32), 256)
+
+    def test_has_leading_zero_bits(self):
+        digest = "\x00\x00\x1f" + "\xff" * 29
+        self.assertTrue(has_leading_zero_bits(digest, 0))
+        self.assertTrue(has_leading_zero_bits(digest, 16))
+        self.assertTrue(has_leading_zero_bits(digest, 19))
+        self.assertFalse(has_leading_zero_bits(digest, 20))
+        self.assertFalse(has_leading_zero_bits(digest, 256))
+        self.assertFalse(has_leading_zero_bits("\x80" + "\x00" * 31, 1))
+
     def test_keys_dir_default(self):
         km = KeysAuth(self.path)
         d1 = km.get_keys_dir()
@@ -32,6 +76,8 @@ class KeysAuthTest(TestWithKeysAuth):
         self.assertGreaterEqual(difficulty, 0)
         difficulty = ka.get_difficulty("j_AUzb*?V0?g^f9,uI:hewjOTLdu8jn5$%s'a#\iJ8q's~Pa")
         self.assertGreaterEqual(difficulty, 0)
+        # sha256("51") starts with 0x03
+        self.assertEqual(ka.get_difficulty("51"), 6)
 
     def test_keys_dir_default2(self):
         self.assertEqual(KeysAuth(self.path).get_keys_dir(), KeysAuth(self.path).get_keys_dir())
@@ -84,6 +130,10 @@ class TestRSAKeysAuth(TestWithKeysAuth):
         data2 = "ABBALJL\nafaoawuoauofa\ru0180141mfa\t" * 100
         signature2 = km2.sign(data2)
         self.assertTrue(km.verify(signature2, data2, km2.public_key))
+        self.assertTrue(km.verify(signature2, data2, km2.public_key.exportKey()))
+        self.assertTrue(km.verify(signature2, data2, km2.public_key.exportKey("OpenSSH")))
+        self.assertFalse(km.verify(signature2, data2, km.public_key.exportKey()))
+        self.assertFalse(km.verify(signature2, data2, "not a key"))
         self.assertFalse(km.verify(signature, data2))
         self.assertFalse(km.verify(signature, [data]))
         self.assertFalse(km.verify(None, data))
@@ -99,6 +149,50 @@ class TestRSAKeysAuth(TestWithKeysAuth):
         km2 = RSAKeysAuth(self.path)
         data = "\x00" + urandom(128)
         self.assertEqual(km.decrypt(km2.encrypt(data, km.public_key)), data)
+        self.assertEqual(km.decrypt(km2.encrypt(data, km.public_key.exportKey())), data)
+
+    def test_reload_rewritten_keys_rsa(self):
+        """ Keys rewritten by RSAKeysAuth are seen by instances created afterwards """
+        km = RSAKeysAuth(self.path)
+        km.generate_new(0)
+        km2 = RSAKeysAuth(self.path)
+        self.assertEqual(km2._private_key.exportKey(), km._private_key.exportKey())
+        self.assertEqual(km2.key_id, km.key_id)
+
+        priv_key_file = path.join(self.path, "priv_rsa_reload.key")
+        with open(priv_key_file, 'w') as f:
+            f.write(generate_rsa_key().exportKey('PEM'))
+        self.assertTrue(km.load_from_file(priv_key_file))
+        km3 = RSAKeysAuth(self.path)
+        self.assertEqual(km3._private_key.exportKey(), km._private_key.exportKey())
+        self.assertEqual(km3.key_id, km.key_id)
+
+    def test_generate_new_keys_export_rsa(self):
+        """ Keys mined with non-standard public exponent can be exported and imported again """
+        from Crypto.PublicKey import RSA
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.serialization import load_pem_private_key, load_pem_public_key, \
+            load_ssh_public_key
+        km = RSAKeysAuth(self.path)
+        km.generate_new(8)
+        priv_key, pub_key = km._private_key, km.get_public_key()
+        priv_pem = priv_key.exportKey('PEM')
+        pub_pem = pub_key.exportKey()
+
+        imported = RSA.importKey(priv_pem)
+        self.assertEqual((imported.n, imported.e, imported.d), (priv_key.n, priv_key.e, priv_key.d))
+        self.assertEqual(imported.exportKey('PEM'), priv_pem)
+        imported = RSA.importKey(pub_pem)
+        self.assertEqual((imported.n, imported.e), (pub_key.n, pub_key.e))
+        self.assertEqual(km.cnt_key_id(imported), km.key_id)
+
+        numbers = load_pem_private_key(priv_pem, None, default_backend()).private_numbers()
+        self.assertEqual((numbers.public_numbers.n, numbers.public_numbers.e, numbers.d),
+                         (priv_key.n, priv_key.e, priv_key.d))
+        numbers = load_pem_public_key(pub_pem, default_backend()).public_numbers()
+        self.assertEqual((numbers.n, numbers.e), (pub_key.n, pub_key.e))
+        numbers = load_ssh_public_key(pub_key.exportKey("OpenSSH"), default_backend()).public_numbers()
+        self.assertEqual((numbers.n, numbers.e), (pub_key.n, pub_key.e))
 
     def test_save_load_keys_rsa(self):
         """ Tests for saving and loading keys """
@@ -116,8 +210,11 @@ class TestRSAKeysAuth(TestWithKeysAuth):
         with self.assertRaises(TypeError):
             ek.generate_new(None)
         ek.generate_new(5)
-        self.assertNotEqual(ek.get_public_key(), pub_key)
-        self.assertNotEqual(ek._private_key, priv_key)
+        self.assertGreaterEqual(ek.get_difficulty(), 5)
+        self.assertEqual(ek.key_id, ek.cnt_key_id(ek.get_public_key()))
+        self.assertTrue(ek.verify(ek.sign("data"), "data"))
+        self.assertNotEqual(ek.get_public_key().exportKey(), pub_key)
+        self.assertNotEqual(ek._private_key.exportKey(), priv_key)
         with open(pub_key_file, 'r') as f:
             self.assertEqual(f.read(), pub_key)
         with open(priv_key_file, 'r') as f:
@@ -147,6 +244,50 @@ class TestEllipticalKeysAuth(TestWithKeysAuth):
             self.assertEqual(len(ek.public_key), 64)
             self.assertEqual(len(ek.key_id), 128)
 
+    def test_privkey_to_key_id_digest(self):
+        priv_key = mk_privkey("qaz123WSX")
+        self.assertEqual(privkey_to_key_id_digest(priv_key), sha256(privtopub(priv_key).encode('hex')).digest())
+
+    @patch('golem.core.keysauth.multiprocessing', Mock(Process=InProcessWorker, Queue=Queue))
+    def test_mine_elliptical_keys(self):
+        priv_key, pub_key = mine_elliptical_keys(4, processes=2)
+        self.assertEqual(privtopub(priv_key), pub_key)
+        self.assertGreaterEqual(EllipticalKeysAuth(self.path).get_difficulty(pub_key.encode('hex')), 4)
+
+    def test_elliptical_init_invalid_private_key(self):
+        ek = EllipticalKeysAuth(self.path, "PRIVATE_INVALID", "PUBLIC_INVALID")
+        with open(ek._get_private_key_loc("PRIVATE_INVALID"), 'wb') as f:
+            f.write("\x00" * 32)
+        ek = EllipticalKeysAuth(self.path, "PRIVATE_INVALID", "PUBLIC_INVALID")
+        self.assertNotEqual(ek._private_key, "\x00" * 32)
+        self.assertEqual(privtopub(ek._private_key), ek.public_key)
+        self.assertEqual(ek.key_id, ek.cnt_key_id(ek.public_key))
+        data = "abcdefgh"
+        self.assertTrue(ek.verify(ek.sign(data), data))
+
+    @patch('golem.core.keysauth.MINING_POLL_INTERVAL', 0.01)
+    @patch('golem.core.keysauth.multiprocessing')
+    def test_mine_elliptical_keys_workers_died(self, multiprocessing):
+        worker = Mock(is_alive=Mock(return_value=False))
+        multiprocessing.Process.return_value = worker
+        multiprocessing.Queue = Queue
+        with self.assertRaises(RuntimeError):
+            mine_elliptical_keys(4, processes=2)
+        self.assertEqual(worker.start.call_count, 2)
+        self.assertEqual(worker.terminate.call_count, 2)
+
+    @patch('golem.core.keysauth.mine_elliptical_keys')
+    @patch('golem.core.keysauth.find_elliptical_keys')
+    def test_generate_new_frozen(self, find, mine):
+        priv_key = mk_privkey("qaz123WSX")
+        find.return_value = priv_key, privtopub(priv_key)
+        ek = EllipticalKeysAuth(self.path)
+        with patch.object(sys, 'frozen', True, create=True):
+            ek.generate_new(PARALLEL_MINING_MIN_DIFFICULTY)
+        find.assert_called_once_with(PARALLEL_MINING_MIN_DIFFICULTY)
+        mine.assert_not_called()
+        self.assertEqual(ek._private_key, priv_key)
+
     def test_sign_verify_elliptical(self):
         ek = EllipticalKeysAuth(self.path)
         data = "abcdefgh\nafjalfa\rtajlajfrlajl\t" * 100